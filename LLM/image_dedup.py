@@ -0,0 +1,100 @@
+"""
+截圖去重工具 - 以感知雜湊（difference hash）判斷截圖是否幾乎相同，並找出變動區域
+"""
+import math
+from typing import Optional, Tuple
+from PIL import Image, ImageChops
+
+
+# 視覺模型每個圖片 token 約對應 28x28 像素（Qwen2.5-VL：14px patch，2x2 合併）
+PIXELS_PER_TOKEN_SIDE = 28
+
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """
+    計算 difference hash（縮成 (hash_size+1) x hash_size 灰階後比較相鄰像素亮度）
+
+    Args:
+        img: PIL 圖片
+        hash_size: 雜湊邊長，預設 8（64 bits）
+
+    Returns:
+        整數形式的雜湊值
+    """
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """兩個雜湊值不同的位元數"""
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """估算一張圖片送進視覺模型佔用的 token 數"""
+    return math.ceil(width / PIXELS_PER_TOKEN_SIDE) * math.ceil(height / PIXELS_PER_TOKEN_SIDE)
+
+
+def changed_bbox(
+    previous: Image.Image,
+    current: Image.Image,
+    noise_threshold: int = 24
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    找出兩張截圖之間有變動像素的外框（尺寸不同時先把前一張縮放到目前的尺寸）
+
+    Args:
+        previous: 前一張截圖
+        current: 目前的截圖
+        noise_threshold: 像素差異低於此值視為 JPEG 雜訊
+
+    Returns:
+        目前截圖座標的 (left, upper, right, lower)，沒有超過雜訊的變動時返回 None
+    """
+    if previous.size != current.size:
+        previous = previous.resize(current.size, Image.Resampling.LANCZOS)
+
+    diff = ImageChops.difference(previous.convert('L'), current.convert('L'))
+    return diff.point(lambda value: 255 if value > noise_threshold else 0).getbbox()
+
+
+def changed_region(
+    previous: Image.Image,
+    current: Image.Image,
+    padding: int = 32,
+    noise_threshold: int = 24
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    找出兩張同尺寸截圖之間有變動的區域
+
+    Args:
+        previous: 前一張截圖
+        current: 目前的截圖
+        padding: 變動區域往外擴張的像素（保留周圍文字脈絡）
+        noise_threshold: 像素差異低於此值視為 JPEG 雜訊
+
+    Returns:
+        (left, upper, right, lower)，尺寸不同或沒有變動時返回 None
+    """
+    if previous.size != current.size:
+        return None
+
+    bbox = changed_bbox(previous, current, noise_threshold)
+    if bbox is None:
+        return None
+
+    left, upper, right, lower = bbox
+    width, height = current.size
+    return (
+        max(0, left - padding),
+        max(0, upper - padding),
+        min(width, right + padding),
+        min(height, lower + padding)
+    )
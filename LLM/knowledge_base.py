@@ -1,25 +1,55 @@
 """
-知識庫管理器 - 使用 ChromaDB 做向量儲存和檢索
+知識庫管理器 - 使用 ChromaDB 做向量儲存和檢索，搭配 BM25 詞彙索引做混合檢索
 """
 import os
 import json
+import re
 import shutil
+import time
 from typing import List, Dict, Optional
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 
+from lexical_index import LexicalIndex
+
 
 class KnowledgeBase:
     """知識庫向量資料庫管理器"""
     
-    def __init__(self, persist_directory: str = None, auto_cleanup: bool = True):
+    # Reciprocal Rank Fusion 的平滑常數
+    RRF_K = 60
+    
+    # 知識庫中的假別名稱
+    LEAVE_TYPES = ['病假', '事假', '喪假', '產假', '生理假', '器官捐贈假',
+                   '心理調適假', '學期考試假', '公假', '歲時祭儀假', '多元文化假']
+    
+    # 預設集合名稱（熱更新時會加上版本後綴）
+    DEFAULT_COLLECTION_NAME = "leave_system_knowledge"
+    
+    def __init__(
+        self,
+        persist_directory: str = None,
+        auto_cleanup: bool = True,
+        collection_name: str = DEFAULT_COLLECTION_NAME,
+        embedding_model: Optional[SentenceTransformer] = None,
+        lexical_fast_path: bool = True,
+        fast_path_min_coverage: float = 0.4,
+        fast_path_min_margin: float = 1.5,
+        fast_path_min_terms: int = 3
+    ):
         """
         初始化知識庫
         
         Args:
             persist_directory: ChromaDB 持久化儲存路徑
             auto_cleanup: 是否自動清理舊的向量資料庫
+            collection_name: ChromaDB 集合名稱
+            embedding_model: 已載入的 embedding 模型（熱更新時共用，避免重複載入）
+            lexical_fast_path: 詞彙比對夠明確時，是否直接返回結果而不呼叫 embedding 模型
+            fast_path_min_coverage: 快速路徑的最低查詢詞涵蓋率（命中詞數 / 查詢全部詞數，0~1）
+            fast_path_min_margin: 快速路徑要求第一名 BM25 分數至少是第二名的幾倍
+            fast_path_min_terms: 快速路徑要求第一名至少命中幾個查詢詞
         """
         if persist_directory is None:
             persist_directory = os.path.join(
@@ -29,6 +59,14 @@ class KnowledgeBase:
             )
         
         self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.lexical_fast_path = lexical_fast_path
+        self.fast_path_min_coverage = fast_path_min_coverage
+        self.fast_path_min_margin = fast_path_min_margin
+        self.fast_path_min_terms = fast_path_min_terms
+        
+        # 檢索統計（快速路徑命中率與省下的 embedding 時間）
+        self.search_stats = self.new_search_stats()
         
         # 自動清理舊版本
         if auto_cleanup:
@@ -41,18 +79,42 @@ class KnowledgeBase:
         self.client = chromadb.PersistentClient(path=persist_directory)
         
         # 初始化 embedding 模型（使用支援中文的模型）
-        print("📦 載入 embedding 模型...")
-        self.embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-        print("✅ Embedding 模型載入完成")
+        if embedding_model is not None:
+            self.embedding_model = embedding_model
+        else:
+            print("📦 載入 embedding 模型...")
+            self.embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+            print("✅ Embedding 模型載入完成")
         
         # 取得或建立集合
         self.collection = self.client.get_or_create_collection(
-            name="leave_system_knowledge",
+            name=self.collection_name,
             metadata={"description": "成大請假系統知識庫"}
         )
         
+        # 從既有的向量資料庫重建詞彙索引
+        self.lexical_index = LexicalIndex()
+        if self.collection.count() > 0:
+            existing = self.collection.get(include=['documents', 'metadatas'])
+            self.lexical_index.build(existing['ids'], existing['documents'], existing['metadatas'])
+        
         print(f"📚 知識庫已初始化，共 {self.collection.count()} 條文檔")
     
+    @staticmethod
+    def new_search_stats() -> Dict:
+        """建立一組歸零的檢索統計"""
+        return {
+            'total_searches': 0,
+            'fast_path_hits': 0,
+            'embedding_calls': 0,
+            'embedding_seconds': 0.0
+        }
+    
+    def record_search_stats(self, stats: Dict):
+        """把另外記錄的檢索統計計入此知識庫（預取的結果被聊天請求沿用時使用）"""
+        for key, value in stats.items():
+            self.search_stats[key] += value
+    
     def _cleanup_old_versions(self):
         """清理舊的向量資料庫版本，保持目錄乾淨"""
         if not os.path.exists(self.persist_directory):
@@ -94,9 +156,9 @@ class KnowledgeBase:
         if self.collection.count() > 0:
             print("⚠️  知識庫已有資料，將清空後重新載入")
             # 清空現有資料
-            self.client.delete_collection("leave_system_knowledge")
+            self.client.delete_collection(self.collection_name)
             self.collection = self.client.create_collection(
-                name="leave_system_knowledge",
+                name=self.collection_name,
                 metadata={"description": "成大請假系統知識庫"}
             )
         
@@ -125,20 +187,13 @@ class KnowledgeBase:
             embeddings=embeddings.tolist()
         )
         
+        # 同步建立詞彙索引
+        self.lexical_index.build(ids, documents, metadatas)
+        
         print(f"✅ 成功載入 {len(documents)} 條知識到向量資料庫")
     
-    def search(self, query: str, top_k: int = 3, category: Optional[str] = None) -> List[Dict]:
-        """
-        搜尋相關知識（改進版：增加同義詞擴展和語義理解）
-        
-        Args:
-            query: 查詢問題
-            top_k: 返回前 k 個最相關的結果
-            category: 可選的分類過濾
-        
-        Returns:
-            相關知識列表
-        """
+    def _analyze_query(self, query: str) -> Dict:
+        """同義詞擴展並判斷問題類型與假別"""
         # 同義詞和口語化映射
         synonyms = {
             '生病': '病假',
@@ -193,16 +248,100 @@ class KnowledgeBase:
         has_ui_question = any(kw in query for kw in ui_keywords)
         
         # 提取查詢中的假別關鍵詞
-        leave_types = ['病假', '事假', '喪假', '產假', '生理假', '器官捐贈假', 
-                       '心理調適假', '學期考試假', '公假', '歲時祭儀假', '多元文化假']
         query_leave_type = None
-        for leave_type in leave_types:
+        for leave_type in self.LEAVE_TYPES:
             if leave_type in expanded_query:
                 query_leave_type = leave_type
                 break
         
+        return {
+            'expanded_query': expanded_query,
+            'query_leave_type': query_leave_type,
+            'has_proof_question': has_proof_question,
+            'has_day_question': has_day_question,
+            'has_process_question': has_process_question,
+            'has_ui_question': has_ui_question
+        }
+    
+    def query_signature(self, query: str) -> Optional[str]:
+        """
+        查詢的檢索特徵（擴展後查詢去除空白與標點、轉小寫後的文字），用來判斷預取結果能否沿用
+        
+        向量檢索會對整段擴展後查詢做 embedding，只比對假別或索引詞不足以保證結果相同，
+        例如「我想請假」與「我不想請假」的索引詞完全一樣；擴展後查詢沒有任何索引詞時返回 None（不可沿用）
+        """
+        expanded_query = self._analyze_query(query)['expanded_query']
+        if not any(term in self.lexical_index.idf for term in self.lexical_index.tokenize(expanded_query)):
+            return None
+        return re.sub(r'[\W_]+', '', expanded_query.lower())
+    
+    def search(
+        self,
+        query: str,
+        top_k: int = 3,
+        category: Optional[str] = None,
+        include_scores: bool = False,
+        stats: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        搜尋相關知識（改進版：增加同義詞擴展和語義理解）
+        
+        Args:
+            query: 查詢問題
+            top_k: 返回前 k 個最相關的結果
+            category: 可選的分類過濾
+            include_scores: 是否在每筆結果附上 confidence（詞彙比對的信心指標，所有檢索路徑使用同一尺度）：
+                matched_terms 命中的查詢詞數、coverage 命中詞數占查詢全部詞數的比例、
+                margin 該文檔 BM25 分數相對於其他文檔最高分的倍數（沒有其他文檔命中時為無限大）
+            stats: 記錄檢索統計的目標（預設為 search_stats；預取另外記錄，沿用時才計入）
+        
+        Returns:
+            相關知識列表
+        """
+        analysis = self._analyze_query(query)
+        expanded_query = analysis['expanded_query']
+        query_leave_type = analysis['query_leave_type']
+        has_ui_question = analysis['has_ui_question']
+        stats = self.search_stats if stats is None else stats
+        
+        stats['total_searches'] += 1
+        
+        # 詞彙檢索（BM25，不需要 embedding）
+        lexical_results = self.lexical_index.search(
+            expanded_query,
+            top_k=max(top_k * 4, 12),
+            category=category
+        )
+        lexical_ranks = {result['id']: rank for rank, result in enumerate(lexical_results)}
+        
+        # 快速路徑：詞彙比對已經很明確時不呼叫 embedding 模型，
+        # 詞彙候選經過與向量路徑相同的假別過濾、問題類型過濾與重排序後返回 top_k 筆
+        if self.lexical_fast_path and self._is_lexical_decisive(lexical_results, query_leave_type):
+            stats['fast_path_hits'] += 1
+            candidates = [
+                {
+                    'id': result['id'],
+                    'content': result['content'],
+                    'category': result['category'],
+                    'distance': None,
+                    'score': 1.0 / (self.RRF_K + rank + 1)
+                }
+                for rank, result in enumerate(lexical_results)
+            ]
+            
+            if query_leave_type and not category and not has_ui_question:
+                category_candidates = [c for c in candidates if c['category'] == query_leave_type]
+                formatted_results = self._filter_by_question_type(category_candidates, analysis, top_k)
+                if formatted_results:
+                    return self._finalize_results(formatted_results, include_scores, lexical_results)
+            
+            return self._finalize_results(self._rerank(candidates, analysis, top_k), include_scores, lexical_results)
+        
         # 建立查詢 embedding（使用擴展後的查詢）
+        embed_start = time.perf_counter()
         query_embedding = self.embedding_model.encode([expanded_query])[0]
+        stats['embedding_calls'] += 1
+        stats['embedding_seconds'] += time.perf_counter() - embed_start
         
         # 如果檢測到特定假別，且不是UI相關問題，先嘗試用分類過濾搜尋
         if query_leave_type and not category and not has_ui_question:
@@ -215,27 +354,25 @@ class KnowledgeBase:
             
             # 如果找到相關結果，優先使用
             if category_results['documents'] and len(category_results['documents'][0]) > 0:
-                formatted_results = []
-                for i in range(len(category_results['documents'][0])):
-                    doc = category_results['documents'][0][i]
-                    
-                    # 根據問題類型過濾
-                    if has_proof_question and '證明' not in doc:
-                        continue  # 跳過不含證明資訊的文檔
-                    if has_day_question and not any(d in doc for d in ['天', '上限', '限']):
-                        continue  # 跳過不含天數資訊的文檔
-                    
-                    formatted_results.append({
-                        'content': doc,
+                # 向量排名與詞彙排名融合後再依序篩選
+                fused_order = sorted(
+                    range(len(category_results['documents'][0])),
+                    key=lambda i: self._rrf_score(i, category_results['ids'][0][i], lexical_ranks),
+                    reverse=True
+                )
+                
+                formatted_results = self._filter_by_question_type([
+                    {
+                        'id': category_results['ids'][0][i],
+                        'content': category_results['documents'][0][i],
                         'category': category_results['metadatas'][0][i]['category'],
                         'distance': category_results['distances'][0][i] if 'distances' in category_results else None
-                    })
-                    
-                    if len(formatted_results) >= top_k:
-                        break
+                    }
+                    for i in fused_order
+                ], analysis, top_k)
                 
                 if formatted_results:
-                    return formatted_results[:top_k]
+                    return self._finalize_results(formatted_results, include_scores, lexical_results)
         
         # 準備過濾條件
         where_filter = {"category": category} if category else None
@@ -248,60 +385,183 @@ class KnowledgeBase:
             where=where_filter
         )
         
-        # 格式化並重排序結果
-        formatted_results = []
+        # 合併兩個檢索器的候選文檔（Reciprocal Rank Fusion 作為基礎分數）
+        candidates = []
+        seen_ids = set()
         if results['documents'] and len(results['documents'][0]) > 0:
             for i in range(len(results['documents'][0])):
-                doc = results['documents'][0][i]
-                cat = results['metadatas'][0][i]['category']
-                dist = results['distances'][0][i] if 'distances' in results else 0
-                
-                # 計算相關性分數（距離越小越好）
-                score = 1.0 / (1.0 + dist)  # 轉換為相似度分數
-                
-                # 如果問題中包含特定假別，調整分數
-                if query_leave_type:
-                    # 分類完全匹配，大幅提升
-                    if cat == query_leave_type:
-                        score *= 100.0
-                    # 內容包含該假別
-                    elif query_leave_type in doc:
-                        score *= 10.0
-                    # 包含其他假別但不是查詢的假別，降低分數
-                    elif any(lt in cat or lt in doc for lt in leave_types if lt != query_leave_type):
-                        score *= 0.1
-                
-                # 根據問題類型調整分數
-                if has_proof_question and '證明' in doc:
-                    score *= 2.0
-                if has_day_question and any(d in doc for d in ['天', '上限', '限']):
-                    score *= 2.0
-                if has_process_question and any(p in doc for p in ['申請', '核准', '報備']):
-                    score *= 1.5
-                
-                formatted_results.append({
-                    'content': doc,
-                    'category': cat,
-                    'distance': dist,
-                    'score': score
+                doc_id = results['ids'][0][i]
+                seen_ids.add(doc_id)
+                candidates.append({
+                    'id': doc_id,
+                    'content': results['documents'][0][i],
+                    'category': results['metadatas'][0][i]['category'],
+                    'distance': results['distances'][0][i] if 'distances' in results else 0,
+                    'score': self._rrf_score(i, doc_id, lexical_ranks)
                 })
+        
+        # 只被詞彙檢索找到的文檔也納入候選
+        for rank, result in enumerate(lexical_results[:search_k]):
+            if result['id'] not in seen_ids:
+                candidates.append({
+                    'id': result['id'],
+                    'content': result['content'],
+                    'category': result['category'],
+                    'distance': None,
+                    'score': 1.0 / (self.RRF_K + rank + 1)
+                })
+        
+        return self._finalize_results(self._rerank(candidates, analysis, top_k), include_scores, lexical_results)
+    
+    def _filter_by_question_type(self, candidates: List[Dict], analysis: Dict, top_k: int) -> List[Dict]:
+        """依序保留符合問題類型的文檔（問證明時需含證明資訊、問天數時需含天數資訊），最多 top_k 筆"""
+        formatted_results = []
+        for candidate in candidates:
+            doc = candidate['content']
             
-            # 按分數排序並取前 top_k 個
-            formatted_results.sort(key=lambda x: x['score'], reverse=True)
-            formatted_results = formatted_results[:top_k]
+            # 根據問題類型過濾
+            if analysis['has_proof_question'] and '證明' not in doc:
+                continue  # 跳過不含證明資訊的文檔
+            if analysis['has_day_question'] and not any(d in doc for d in ['天', '上限', '限']):
+                continue  # 跳過不含天數資訊的文檔
             
-            # 移除內部使用的 score 欄位
-            for result in formatted_results:
-                del result['score']
-        
+            formatted_results.append(candidate)
+            if len(formatted_results) >= top_k:
+                break
         return formatted_results
     
+    def _rerank(self, candidates: List[Dict], analysis: Dict, top_k: int) -> List[Dict]:
+        """依假別與問題類型調整候選文檔的分數，返回分數最高的 top_k 筆"""
+        query_leave_type = analysis['query_leave_type']
+        leave_types = self.LEAVE_TYPES
+        
+        formatted_results = []
+        for candidate in candidates:
+            doc = candidate['content']
+            cat = candidate['category']
+            score = candidate['score']
+            
+            # 如果問題中包含特定假別，調整分數
+            if query_leave_type:
+                # 分類完全匹配，大幅提升
+                if cat == query_leave_type:
+                    score *= 100.0
+                # 內容包含該假別
+                elif query_leave_type in doc:
+                    score *= 10.0
+                # 包含其他假別但不是查詢的假別，降低分數
+                elif any(lt in cat or lt in doc for lt in leave_types if lt != query_leave_type):
+                    score *= 0.1
+            
+            # 根據問題類型調整分數
+            if analysis['has_proof_question'] and '證明' in doc:
+                score *= 2.0
+            if analysis['has_day_question'] and any(d in doc for d in ['天', '上限', '限']):
+                score *= 2.0
+            if analysis['has_process_question'] and any(p in doc for p in ['申請', '核准', '報備']):
+                score *= 1.5
+            
+            candidate['score'] = score
+            formatted_results.append(candidate)
+        
+        # 按分數排序並取前 top_k 個
+        formatted_results.sort(key=lambda x: x['score'], reverse=True)
+        return formatted_results[:top_k]
+    
+    def _finalize_results(
+        self,
+        results: List[Dict],
+        include_scores: bool,
+        lexical_results: List[Dict]
+    ) -> List[Dict]:
+        """移除內部使用的欄位，需要時附上詞彙比對的信心指標"""
+        for result in results:
+            doc_id = result.pop('id')
+            result.pop('score', None)
+            if include_scores:
+                result['confidence'] = self._lexical_confidence(doc_id, lexical_results)
+        return results
+    
+    def _lexical_confidence(self, doc_id: str, lexical_results: List[Dict]) -> Dict:
+        """以 BM25 結果計算單一文檔的信心指標（與檢索路徑無關，尺度一致）"""
+        own = next((result for result in lexical_results if result['id'] == doc_id), None)
+        if own is None:
+            return {'matched_terms': 0, 'coverage': 0.0, 'margin': 0.0}
+        
+        runner_up = max((result['score'] for result in lexical_results if result['id'] != doc_id), default=0.0)
+        return {
+            'matched_terms': own['matched_terms'],
+            'coverage': own['coverage'],
+            'margin': own['score'] / runner_up if runner_up else float('inf')
+        }
+    
+    def _rrf_score(self, vector_rank: int, doc_id: str, lexical_ranks: Dict[str, int]) -> float:
+        """計算向量排名與詞彙排名的 Reciprocal Rank Fusion 分數"""
+        score = 1.0 / (self.RRF_K + vector_rank + 1)
+        if doc_id in lexical_ranks:
+            score += 1.0 / (self.RRF_K + lexical_ranks[doc_id] + 1)
+        return score
+    
+    def _is_lexical_decisive(self, lexical_results: List[Dict], query_leave_type: Optional[str]) -> bool:
+        """判斷詞彙檢索的第一名是否夠明確，可以跳過向量檢索"""
+        if not lexical_results:
+            return False
+        
+        top = lexical_results[0]
+        if top['coverage'] < self.fast_path_min_coverage:
+            return False
+        if top['matched_terms'] < self.fast_path_min_terms:
+            return False
+        if len(lexical_results) > 1 and top['score'] < lexical_results[1]['score'] * self.fast_path_min_margin:
+            return False
+        
+        # 問題指定了假別時，第一名必須是該假別的文檔
+        if query_leave_type and top['category'] != query_leave_type and query_leave_type not in top['content']:
+            return False
+        
+        return True
+    
+    def drop(self):
+        """刪除此知識庫的向量集合（熱更新後清理舊版本使用）"""
+        try:
+            self.client.delete_collection(self.collection_name)
+            print(f"🧹 已刪除舊的向量集合: {self.collection_name}")
+        except Exception as e:
+            print(f"⚠️  無法刪除向量集合 {self.collection_name}: {e}")
+    
+    def drop_other_collections(self, prefix: str = DEFAULT_COLLECTION_NAME):
+        """刪除同一資料庫中其他版本的向量集合（名稱以 prefix 開頭）"""
+        for collection in self.client.list_collections():
+            # 新版 ChromaDB 返回名稱，舊版返回 Collection 物件
+            name = getattr(collection, 'name', collection)
+            if name.startswith(prefix) and name != self.collection_name:
+                try:
+                    self.client.delete_collection(name)
+                    print(f"🧹 已刪除過期的向量集合: {name}")
+                except Exception as e:
+                    print(f"⚠️  無法刪除向量集合 {name}: {e}")
+    
     def get_stats(self) -> Dict:
         """取得知識庫統計資訊"""
         count = self.collection.count()
+        stats = self.search_stats
+        avg_embedding_seconds = (
+            stats['embedding_seconds'] / stats['embedding_calls'] if stats['embedding_calls'] else 0.0
+        )
         return {
             'total_documents': count,
-            'collection_name': self.collection.name
+            'collection_name': self.collection.name,
+            'lexical_index_documents': len(self.lexical_index),
+            'search': {
+                'total_searches': stats['total_searches'],
+                'fast_path_hits': stats['fast_path_hits'],
+                'fast_path_rate': (
+                    stats['fast_path_hits'] / stats['total_searches'] if stats['total_searches'] else 0.0
+                ),
+                'avg_embedding_seconds': avg_embedding_seconds,
+                # 以平均 embedding 時間估算快速路徑省下的時間
+                'estimated_seconds_saved': stats['fast_path_hits'] * avg_embedding_seconds
+            }
         }
 
 
@@ -356,3 +616,16 @@ if __name__ == "__main__":
             results = kb.search(query, top_k=2)
             for i, result in enumerate(results, 1):
                 print(f"  {i}. [{result['category']}] {result['content'][:50]}...")
+        
+        # 測試預取沿用判斷：以下每組的檢索結果不同，特徵必須不同（或無法沿用）
+        print("\n🔍 測試預取檢索特徵...")
+        signature_pairs = [
+            ("how do I apply", "how do I apply for funeral leave"),
+            ("我發燒了", "我頭痛"),
+            ("我想請假", "我不想請假"),
+            ("病假要證明", "病假不要證明"),
+        ]
+        for partial, final in signature_pairs:
+            partial_signature = kb.query_signature(partial)
+            reusable = partial_signature is not None and partial_signature == kb.query_signature(final)
+            print(f"  {'❌ 誤判可沿用' if reusable else '✅ 不沿用'}: 「{partial}」 -> 「{final}」")
@@ -0,0 +1,119 @@
+"""
+詞彙索引 - 以字元 n-gram 建立 BM25 倒排索引（不需要 embedding 模型）
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from typing import List, Dict, Optional, Tuple
+
+
+class LexicalIndex:
+    """字元 n-gram BM25 倒排索引"""
+
+    def __init__(self, ngram_range: Tuple[int, int] = (2, 2), k1: float = 1.5, b: float = 0.75):
+        """
+        初始化詞彙索引
+
+        Args:
+            ngram_range: 字元 n-gram 長度範圍（預設只用雙字，單字雜訊太多）
+            k1: BM25 詞頻飽和參數
+            b: BM25 文檔長度正規化參數
+        """
+        self.ngram_range = ngram_range
+        self.k1 = k1
+        self.b = b
+        self._clear()
+
+    def _clear(self):
+        """清空索引內容"""
+        self.doc_ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: List[int] = []
+        self.avg_doc_length = 0.0
+        self.idf: Dict[str, float] = {}
+
+    def tokenize(self, text: str) -> List[str]:
+        """將文字切成字元 n-gram（只在同一段文字內切，不跨越標點與空白）"""
+        tokens = []
+        min_n, max_n = self.ngram_range
+        for segment in re.findall(r'\w+', text.lower()):
+            for n in range(min_n, max_n + 1):
+                for i in range(len(segment) - n + 1):
+                    tokens.append(segment[i:i + n])
+        return tokens
+
+    def build(self, ids: List[str], documents: List[str], metadatas: List[Dict]):
+        """
+        建立索引（會覆蓋現有內容）
+
+        Args:
+            ids: 文檔 ID（與向量資料庫一致）
+            documents: 文檔內容
+            metadatas: 文檔 metadata（需包含 category）
+        """
+        self._clear()
+        self.doc_ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = list(metadatas)
+
+        for doc_idx, doc in enumerate(self.documents):
+            term_freqs = Counter(self.tokenize(doc))
+            self.doc_lengths.append(sum(term_freqs.values()))
+            for term, freq in term_freqs.items():
+                self.postings[term].append((doc_idx, freq))
+
+        total_docs = len(self.documents)
+        if total_docs:
+            self.avg_doc_length = sum(self.doc_lengths) / total_docs
+        for term, posting in self.postings.items():
+            df = len(posting)
+            self.idf[term] = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, top_k: int = 3, category: Optional[str] = None) -> List[Dict]:
+        """
+        以 BM25 搜尋
+
+        Args:
+            query: 查詢文字
+            top_k: 返回前 k 個結果
+            category: 可選的分類過濾
+
+        Returns:
+            結果列表，每筆包含 id、content、category、score、coverage、matched_terms
+            （coverage 為文檔命中的查詢詞數除以查詢的全部詞數，0~1；
+            口語問句中常有索引裡沒有的詞，例如「假每」「月可」，因此自然問句的涵蓋率通常不高）
+        """
+        all_terms = set(self.tokenize(query))
+        query_terms = [t for t in all_terms if t in self.idf]
+        if not query_terms or not self.documents:
+            return []
+
+        scores: Dict[int, float] = defaultdict(float)
+        matched_terms: Dict[int, int] = defaultdict(int)
+
+        for term in query_terms:
+            idf = self.idf[term]
+            for doc_idx, freq in self.postings[term]:
+                if category and self.metadatas[doc_idx].get('category') != category:
+                    continue
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_idx] / self.avg_doc_length
+                scores[doc_idx] += idf * freq * (self.k1 + 1) / (freq + self.k1 * length_norm)
+                matched_terms[doc_idx] += 1
+
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        return [
+            {
+                'id': self.doc_ids[doc_idx],
+                'content': self.documents[doc_idx],
+                'category': self.metadatas[doc_idx].get('category'),
+                'score': score,
+                'coverage': matched_terms[doc_idx] / len(all_terms),
+                'matched_terms': matched_terms[doc_idx]
+            }
+            for doc_idx, score in ranked
+        ]
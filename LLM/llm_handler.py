@@ -5,6 +5,12 @@ from dotenv import load_dotenv
 import base64
 import re
 import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 
@@ -13,20 +19,50 @@ import ollama
 
 # 導入知識庫管理器
 from knowledge_base import KnowledgeBase
+from image_dedup import dhash, hamming_distance, estimate_image_tokens, changed_region, changed_bbox
 
 # 載入環境變數
 load_dotenv()
 
 
+class KnowledgeSnapshot:
+    """同一版本的知識庫與系統提示詞（熱更新時整組替換）"""
+    
+    def __init__(self, knowledge_base: Optional[KnowledgeBase], system_prompt: str, version: str):
+        self.knowledge_base = knowledge_base
+        self.system_prompt = system_prompt
+        self.version = version
+        self.in_flight = 0  # 正在使用此版本的請求數
+        self.retired = False  # 已被新版本取代，請求全部結束後即可清理
+
+
 class LLMHandler:
     """處理 LLM 對話的主要類別"""
     
+    # 直接回答模式的預設值（可在 config.json 各知識庫的 direct_answer 區塊覆寫）
+    DIRECT_ANSWER_DEFAULTS = {
+        "enabled": False,
+        "min_terms": 3,
+        "min_coverage": 0.4,
+        "min_dominance": 2.0,
+        "template": "{content}\n\n（以上內容取自知識庫「{category}」，如需更詳細的說明，歡迎繼續提問）"
+    }
+    
     def __init__(self):
         """初始化 LLM Handler"""
         self.base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         self.model_name = os.getenv("OLLAMA_MODEL", "qwen2.5vl:7b")
         self.temperature = float(os.getenv("TEMPERATURE", "0.7"))
         self.max_tokens = int(os.getenv("MAX_TOKENS", "1000"))
+        self.prefetch_ttl = float(os.getenv("PREFETCH_TTL", "30"))
+        self.watch_interval = float(os.getenv("KNOWLEDGE_WATCH_INTERVAL", "5"))
+        self.image_dedup_enabled = os.getenv("IMAGE_DEDUP", "true").lower() == "true"
+        self.image_dedup_threshold = int(os.getenv("IMAGE_DEDUP_THRESHOLD", "4"))
+        self.image_dedup_max_changed_width = int(os.getenv("IMAGE_DEDUP_MAX_CHANGED_WIDTH", "6"))
+        self.image_dedup_max_changed_height = int(os.getenv("IMAGE_DEDUP_MAX_CHANGED_HEIGHT", "40"))
+        self.image_crop_enabled = os.getenv("IMAGE_CROP_CHANGED", "false").lower() == "true"
+        self.image_crop_threshold = int(os.getenv("IMAGE_CROP_THRESHOLD", "16"))
+        self.image_crop_max_area = float(os.getenv("IMAGE_CROP_MAX_AREA", "0.5"))
         
         # 初始化 Ollama 客戶端
         self.client = ollama.Client(host=self.base_url)
@@ -37,12 +73,75 @@ class LLMHandler:
         # 載入知識庫配置
         self.config = self._load_config()
         
-        # 初始化知識庫
-        self.knowledge_base = self._init_knowledge_base()
+        # 初始化知識庫與系統提示詞（同一版本打包成 snapshot，熱更新時整組替換）
+        self.snapshot_lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.snapshot = self._build_snapshot()
+        self.live_snapshots: List[KnowledgeSnapshot] = [self.snapshot]  # 目前版本與尚未結束的舊版本
+        if self.snapshot.knowledge_base:
+            self.snapshot.knowledge_base.drop_other_collections()
+        print(f"📋 系統提示詞已載入（知識版本 {self.snapshot.version}）")
+        
+        # 熱更新狀態
+        self.reload_stats = {
+            'reloading': False,
+            'reload_count': 0,
+            'last_reload_seconds': None,
+            'last_swap_at': None,
+            'last_error': None
+        }
+        
+        # 載入直接回答設定
+        self.direct_answer_config = self._load_direct_answer_config()
+        
+        # 回應統計（直接回答 vs LLM 生成）
+        self.response_stats = {
+            'direct_answers': 0,
+            'direct_seconds': 0.0,
+            'llm_answers': 0,
+            'llm_seconds': 0.0
+        }
         
-        # 載入系統提示詞
-        self.system_prompt = self._load_system_prompt()
-        print(f"📋 系統提示詞已載入")
+        # 預取檢索：單一背景執行緒（低優先，聊天請求進行中時不執行）
+        self.active_chats = 0
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.prefetch_lock = threading.Lock()
+        self.prefetch_cache: Dict[str, Dict] = {}  # session_id -> {signature, results, search_stats, version, timestamp}
+        self.prefetch_latest: Dict[str, tuple] = {}  # session_id -> (最新的部分輸入, timestamp)
+        self.prefetch_stats = {
+            'requests': 0,
+            'skipped_busy': 0,
+            'runs': 0,
+            'cache_hits': 0,
+            'cache_misses': 0
+        }
+        
+        # 截圖去重：感知雜湊快取（歷史截圖每次請求都會重送）與統計
+        self.image_hash_cache: OrderedDict = OrderedDict()  # base64 雜湊 -> 感知雜湊
+        self.image_stats = {
+            'images_received': 0,
+            'duplicates_dropped': 0,
+            'regions_cropped': 0,
+            'estimated_tokens_saved': 0
+        }
+        
+        # 監看知識庫檔案，變動時自動熱更新
+        if self.watch_interval > 0:
+            threading.Thread(
+                target=self._watch_knowledge_files,
+                name="knowledge-watcher",
+                daemon=True
+            ).start()
+    
+    @property
+    def knowledge_base(self) -> Optional[KnowledgeBase]:
+        """目前版本的知識庫"""
+        return self.snapshot.knowledge_base
+    
+    @property
+    def system_prompt(self) -> str:
+        """目前版本的系統提示詞"""
+        return self.snapshot.system_prompt
     
     def _load_config(self) -> Dict:
         """載入知識庫配置"""
@@ -69,8 +168,8 @@ class LLMHandler:
                 }
             }
     
-    def _load_system_prompt(self) -> str:
-        """從文件載入系統提示詞"""
+    def _load_system_prompt(self, use_default_on_error: bool = True) -> str:
+        """從文件載入系統提示詞（熱更新時不使用預設值，讀取失敗就保留舊版本）"""
         try:
             current_kb = self.config['current_knowledge_base']
             kb_config = self.config['knowledge_bases'][current_kb]
@@ -78,18 +177,205 @@ class LLMHandler:
             with open(prompt_path, 'r', encoding='utf-8') as f:
                 return f.read()
         except Exception as e:
+            if not use_default_on_error:
+                raise
             print(f"⚠️  無法載入系統提示詞: {e}，使用預設值")
             return "你是一個有幫助的AI助理。"
     
-    def _init_knowledge_base(self) -> Optional[KnowledgeBase]:
+    def _knowledge_file_paths(self) -> List[str]:
+        """取得需要監看的知識庫檔案路徑（知識文檔與系統規則）"""
+        current_kb = self.config['current_knowledge_base']
+        kb_config = self.config['knowledge_bases'][current_kb]
+        return [
+            os.path.join(os.path.dirname(__file__), kb_config['qa_knowledge_path']),
+            os.path.join(os.path.dirname(__file__), kb_config['system_rules_path'])
+        ]
+    
+    def _compute_knowledge_version(self) -> str:
+        """
+        以檔案內容計算版本雜湊，格式為「知識文檔雜湊-系統規則雜湊」
+        （只改系統規則時知識文檔雜湊不變，可沿用原本的向量集合不必重新 embedding）
+        """
+        digests = []
+        for path in self._knowledge_file_paths():
+            try:
+                with open(path, 'rb') as f:
+                    digests.append(hashlib.sha256(f.read()).hexdigest()[:8])
+            except OSError:
+                digests.append('missing')
+        return '-'.join(digests)
+    
+    def _knowledge_file_mtimes(self) -> tuple:
+        """取得知識庫檔案的修改時間（檔案不存在時為 None）"""
+        return tuple(
+            os.path.getmtime(path) if os.path.exists(path) else None
+            for path in self._knowledge_file_paths()
+        )
+    
+    def _build_snapshot(
+        self,
+        version: Optional[str] = None,
+        embedding_model=None,
+        for_reload: bool = False
+    ) -> KnowledgeSnapshot:
+        """
+        建立一個版本的知識庫與系統提示詞
+        
+        Args:
+            version: 知識版本雜湊（未提供時重新計算）
+            embedding_model: 共用的 embedding 模型（熱更新時傳入，避免重新載入）
+            for_reload: 熱更新模式（載入失敗直接拋出例外，不使用預設值）
+        """
+        version = version or self._compute_knowledge_version()
+        knowledge_digest = version.split('-')[0]
+        knowledge_base = self._init_knowledge_base(
+            collection_name=f"{KnowledgeBase.DEFAULT_COLLECTION_NAME}_{knowledge_digest}",
+            embedding_model=embedding_model
+        )
+        if for_reload and knowledge_base is None:
+            raise RuntimeError("新版本知識庫建立失敗")
+        system_prompt = self._load_system_prompt(use_default_on_error=not for_reload)
+        return KnowledgeSnapshot(knowledge_base, system_prompt, version)
+    
+    def _acquire_snapshot(self) -> KnowledgeSnapshot:
+        """取得目前版本並標記使用中（請求結束前不會被清理）"""
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            snapshot.in_flight += 1
+            return snapshot
+    
+    def _release_snapshot(self, snapshot: KnowledgeSnapshot):
+        """請求結束，若該版本已被取代且沒有其他請求在使用則清理"""
+        with self.snapshot_lock:
+            snapshot.in_flight -= 1
+            should_drop = snapshot.retired and snapshot.in_flight == 0
+        if should_drop:
+            self._drop_snapshot(snapshot)
+    
+    def _drop_snapshot(self, snapshot: KnowledgeSnapshot):
+        """
+        刪除舊版本的向量集合
+        
+        知識內容相同、只有規則不同的版本共用同一個集合，仍有其他版本（目前版本或尚有請求的舊版本）
+        使用該集合時保留
+        """
+        old_kb = snapshot.knowledge_base
+        with self.snapshot_lock:
+            self.live_snapshots.remove(snapshot)
+            in_use = old_kb is not None and any(
+                live.knowledge_base and live.knowledge_base.collection_name == old_kb.collection_name
+                for live in self.live_snapshots
+            )
+        if old_kb and not in_use:
+            old_kb.drop()
+    
+    def request_reload(self) -> str:
+        """
+        在背景重新載入知識庫與系統提示詞
+        
+        Returns:
+            'started' 或 'already_running'
+        """
+        if not self.reload_lock.acquire(blocking=False):
+            return 'already_running'
+        threading.Thread(target=self._reload_knowledge, name="knowledge-reload", daemon=True).start()
+        return 'started'
+    
+    def _reload_knowledge(self):
+        """建立新版本後原子性替換；進行中的請求繼續使用舊版本直到結束"""
+        self.reload_stats['reloading'] = True
+        start_time = time.perf_counter()
+        try:
+            current = self.snapshot
+            version = self._compute_knowledge_version()
+            # 啟動時知識庫載入失敗（例如 embedding 模型下載失敗）時，版本相同也要重建才能恢復
+            if version == current.version and current.knowledge_base is not None:
+                print(f"🔄 知識版本未變更 ({version})，略過熱更新")
+                return
+            
+            print(f"🔄 開始熱更新知識庫: {current.version} -> {version}")
+            embedding_model = current.knowledge_base.embedding_model if current.knowledge_base else None
+            new_snapshot = self._build_snapshot(version, embedding_model=embedding_model, for_reload=True)
+            
+            # 沿用檢索統計，/api/stats 的快速路徑數據才不會在每次熱更新後歸零
+            if current.knowledge_base:
+                new_snapshot.knowledge_base.search_stats = current.knowledge_base.search_stats
+            
+            with self.snapshot_lock:
+                old_snapshot = self.snapshot
+                self.snapshot = new_snapshot
+                self.live_snapshots.append(new_snapshot)
+                old_snapshot.retired = True
+                should_drop = old_snapshot.in_flight == 0
+            
+            self.reload_stats['reload_count'] += 1
+            self.reload_stats['last_swap_at'] = datetime.now().isoformat(timespec='seconds')
+            self.reload_stats['last_error'] = None
+            print(f"✅ 知識庫熱更新完成，目前版本: {version}")
+            
+            if should_drop:
+                self._drop_snapshot(old_snapshot)
+        except Exception as e:
+            self.reload_stats['last_error'] = str(e)
+            print(f"❌ 知識庫熱更新失敗，繼續使用舊版本: {e}")
+        finally:
+            self.reload_stats['last_reload_seconds'] = time.perf_counter() - start_time
+            self.reload_stats['reloading'] = False
+            self.reload_lock.release()
+    
+    def _watch_knowledge_files(self):
+        """定期檢查知識庫檔案，變動且寫入完成後觸發熱更新"""
+        last_mtimes = self._knowledge_file_mtimes()
+        pending = False
+        while True:
+            time.sleep(self.watch_interval)
+            mtimes = self._knowledge_file_mtimes()
+            if mtimes != last_mtimes:
+                # 檔案剛變動，等下一輪確認沒有繼續寫入再重載
+                last_mtimes = mtimes
+                pending = True
+                continue
+            if pending and self.request_reload() != 'already_running':
+                pending = False
+    
+    def get_reload_status(self) -> Dict:
+        """取得熱更新狀態（目前版本、上次重載耗時與替換時間）"""
+        return {
+            'version': self.snapshot.version,
+            **self.reload_stats
+        }
+    
+    def _load_direct_answer_config(self) -> Dict:
+        """載入目前知識庫的直接回答門檻設定"""
+        current_kb = self.config['current_knowledge_base']
+        kb_config = self.config['knowledge_bases'][current_kb]
+        config = {**self.DIRECT_ANSWER_DEFAULTS, **kb_config.get('direct_answer', {})}
+        if config['enabled']:
+            print(f"⚡ 直接回答模式已啟用 (命中詞數 ≥ {config['min_terms']}, "
+                  f"涵蓋率 ≥ {config['min_coverage']}, 領先倍數 ≥ {config['min_dominance']})")
+        return config
+    
+    def _init_knowledge_base(
+        self,
+        collection_name: str = KnowledgeBase.DEFAULT_COLLECTION_NAME,
+        embedding_model=None
+    ) -> Optional[KnowledgeBase]:
         """初始化知識庫"""
         try:
             current_kb = self.config['current_knowledge_base']
             kb_config = self.config['knowledge_bases'][current_kb]
             
-            # 初始化知識庫（傳入 vectordb 路徑）
+            # 初始化知識庫（傳入 vectordb 路徑與檢索設定）
             vectordb_path = os.path.join(os.path.dirname(__file__), kb_config['vectordb_path'])
-            kb = KnowledgeBase(persist_directory=vectordb_path)
+            kb = KnowledgeBase(
+                persist_directory=vectordb_path,
+                # 每個版本各自一個集合，舊版本由 drop() / drop_other_collections() 透過 ChromaDB 刪除；
+                # 直接刪除 UUID 資料夾會毀掉仍登記在 chroma.sqlite3 中的現役集合
+                auto_cleanup=False,
+                collection_name=collection_name,
+                embedding_model=embedding_model,
+                **kb_config.get('retrieval', {})
+            )
             
             # 如果知識庫是空的，載入資料
             if kb.collection.count() == 0:
@@ -115,7 +401,9 @@ class LLMHandler:
         self, 
         message: str, 
         image: Optional[str] = None,
-        history: Optional[List[Dict]] = None
+        history: Optional[List[Dict]] = None,
+        force_llm: bool = False,
+        session_id: Optional[str] = None
     ) -> str:
         """
         生成 AI 回應
@@ -124,22 +412,40 @@ class LLMHandler:
             message: 用戶輸入的文字訊息
             image: Base64 編碼的圖片（可選）
             history: 對話歷史（可選）
+            force_llm: 強制使用 LLM 生成，不走直接回答模式
+            session_id: 對話 session ID（用來取用預取的檢索結果，可選）
         
         Returns:
             AI 的回應文字
         """
+        start_time = time.perf_counter()
+        self.active_chats += 1
+        # 整個請求使用同一版本（熱更新時進行中的請求繼續使用舊版本）
+        snapshot = self._acquire_snapshot()
         try:
-            # RAG: 檢索相關知識
+            # RAG: 檢索相關知識（優先使用輸入時預取的結果）
             relevant_knowledge = ""
-            if self.knowledge_base and message:
-                search_results = self.knowledge_base.search(message, top_k=3)
+            search_results = []
+            if snapshot.knowledge_base and message:
+                search_results = self._take_prefetched(session_id, message, snapshot)
+                if search_results is None:
+                    search_results = snapshot.knowledge_base.search(message, top_k=3, include_scores=True)
                 if search_results:
                     relevant_knowledge = "\n\n## 相關知識參考：\n"
                     for i, result in enumerate(search_results, 1):
                         relevant_knowledge += f"\n{i}. [{result['category']}] {result['content']}\n"
             
+            # 直接回答：沒有前文的純文字問題且檢索到單一明確的匹配時，直接使用知識庫內容，不呼叫 LLM
+            # （追問需要前文脈絡，模板無法處理，因此有對話歷史時一律交給 LLM）
+            if not force_llm and not image and not history:
+                direct_answer = self._try_direct_answer(search_results)
+                if direct_answer:
+                    self._record_response('direct', start_time)
+                    print(f"⚡ 直接回答（知識庫: {search_results[0]['category']}）")
+                    return direct_answer
+            
             # 構建系統提示詞（包含檢索到的知識）
-            system_content = self.system_prompt
+            system_content = snapshot.system_prompt
             if relevant_knowledge:
                 system_content += relevant_knowledge
             
@@ -177,6 +483,10 @@ class LLMHandler:
             
             messages.append(current_message)
             
+            # 移除重複的截圖，減少圖片 token
+            if self.image_dedup_enabled:
+                self._deduplicate_images(messages)
+            
             # 調用 Ollama (在線程池中運行同步調用)
             loop = asyncio.get_event_loop()
             response = await loop.run_in_executor(
@@ -191,6 +501,7 @@ class LLMHandler:
                 )
             )
             
+            self._record_response('llm', start_time)
             return response['message']['content']
         
         except Exception as e:
@@ -198,6 +509,252 @@ class LLMHandler:
             import traceback
             traceback.print_exc()
             return f"抱歉，處理您的請求時發生錯誤: {str(e)}"
+        
+        finally:
+            self._release_snapshot(snapshot)
+            self.active_chats -= 1
+    
+    def prefetch(self, session_id: str, message: str) -> str:
+        """
+        用戶輸入中就先做檢索（同義詞擴展 + embedding + 向量搜尋），結果暫存給 /api/chat 使用
+        
+        Args:
+            session_id: 對話 session ID
+            message: 目前輸入框中的部分文字
+        
+        Returns:
+            'scheduled' 或 'skipped'
+        """
+        self._count_prefetch('requests')
+        if not self.knowledge_base or len(self._normalize_query(message)) < 2:
+            return 'skipped'
+        
+        # 聊天請求進行中時不預取，避免搶資源
+        if self.active_chats > 0:
+            self._count_prefetch('skipped_busy')
+            return 'skipped'
+        
+        with self.prefetch_lock:
+            self.prefetch_latest[session_id] = (message, time.time())
+            self._prune_prefetch_cache()
+        
+        self.prefetch_executor.submit(self._run_prefetch, session_id, message)
+        return 'scheduled'
+    
+    def _run_prefetch(self, session_id: str, message: str):
+        """在背景執行緒中執行預取（輸入已更新或有聊天請求時直接放棄）"""
+        with self.prefetch_lock:
+            latest = self.prefetch_latest.get(session_id)
+            if latest is None or latest[0] != message:
+                return
+        if self.active_chats > 0:
+            self._count_prefetch('skipped_busy')
+            return
+        
+        snapshot = self._acquire_snapshot()
+        try:
+            # 沒有任何索引詞的輸入不可能沿用，不必檢索
+            signature = snapshot.knowledge_base.query_signature(message)
+            if signature is None:
+                return
+            # 預取的檢索統計另外記錄，被聊天請求沿用時才計入 /api/stats（打字停頓不算一次檢索）
+            search_stats = KnowledgeBase.new_search_stats()
+            results = snapshot.knowledge_base.search(message, top_k=3, include_scores=True, stats=search_stats)
+        except Exception as e:
+            print(f"⚠️  預取檢索失敗: {e}")
+            return
+        finally:
+            self._release_snapshot(snapshot)
+        
+        with self.prefetch_lock:
+            self.prefetch_stats['runs'] += 1
+            self.prefetch_cache[session_id] = {
+                'signature': signature,
+                'results': results,
+                'search_stats': search_stats,
+                'version': snapshot.version,
+                'timestamp': time.time()
+            }
+    
+    def _take_prefetched(self, session_id: Optional[str], message: str, snapshot: KnowledgeSnapshot) -> Optional[List[Dict]]:
+        """
+        取出可沿用的預取結果（用過即刪除）
+        
+        只在同一知識版本、且最終訊息擴展後的查詢（去除空白與標點）與預取時完全相同才沿用；
+        字串相似度與索引詞都不可靠，例如「病假要證明」與「病假不要證明」的索引詞相同，向量檢索結果卻不同
+        """
+        if not session_id:
+            return None
+        
+        with self.prefetch_lock:
+            entry = self.prefetch_cache.pop(session_id, None)
+            self.prefetch_latest.pop(session_id, None)
+        
+        if entry and entry['version'] == snapshot.version and time.time() - entry['timestamp'] <= self.prefetch_ttl:
+            signature = snapshot.knowledge_base.query_signature(message)
+            if signature is not None and entry['signature'] == signature:
+                self._count_prefetch('cache_hits')
+                snapshot.knowledge_base.record_search_stats(entry['search_stats'])
+                return [dict(result) for result in entry['results']]
+        
+        self._count_prefetch('cache_misses')
+        return None
+    
+    def _prefetch_stats_snapshot(self) -> Dict:
+        """在鎖內複製預取統計"""
+        with self.prefetch_lock:
+            return dict(self.prefetch_stats)
+    
+    def _count_prefetch(self, key: str):
+        """更新預取統計（事件迴圈與背景執行緒都會呼叫）"""
+        with self.prefetch_lock:
+            self.prefetch_stats[key] += 1
+    
+    def _prune_prefetch_cache(self):
+        """移除過期的預取結果與輸入紀錄（呼叫端需持有 prefetch_lock）"""
+        now = time.time()
+        for session_id in [sid for sid, entry in self.prefetch_cache.items()
+                           if now - entry['timestamp'] > self.prefetch_ttl]:
+            del self.prefetch_cache[session_id]
+        for session_id in [sid for sid, (_, timestamp) in self.prefetch_latest.items()
+                           if now - timestamp > self.prefetch_ttl]:
+            del self.prefetch_latest[session_id]
+    
+    @staticmethod
+    def _normalize_query(message: str) -> str:
+        """移除空白與標點，用來比對預取的查詢與最終訊息"""
+        return re.sub(r'[\W_]+', '', message or '')
+    
+    def _try_direct_answer(self, search_results: List[Dict]) -> Optional[str]:
+        """
+        檢索結果有單一明確的高信心匹配時，以模板組出回答
+        
+        Args:
+            search_results: 含 confidence 的檢索結果（search 的 include_scores=True）
+        
+        Returns:
+            直接回答的文字，不符合條件時返回 None
+        """
+        config = self.direct_answer_config
+        if not config['enabled'] or not search_results:
+            return None
+        
+        # 信心指標以整個知識庫的詞彙比對計算，不受檢索路徑與過濾後剩下幾筆影響
+        top = search_results[0]
+        confidence = top['confidence']
+        if confidence['matched_terms'] < config['min_terms']:
+            return None
+        if confidence['coverage'] < config['min_coverage']:
+            return None
+        if confidence['margin'] < config['min_dominance']:
+            return None
+        
+        return config['template'].format(content=top['content'], category=top['category'])
+    
+    def _record_response(self, route: str, start_time: float):
+        """記錄回應路徑與耗時（route: 'direct' 或 'llm'）"""
+        elapsed = time.perf_counter() - start_time
+        if route == 'direct':
+            self.response_stats['direct_answers'] += 1
+            self.response_stats['direct_seconds'] += elapsed
+        else:
+            self.response_stats['llm_answers'] += 1
+            self.response_stats['llm_seconds'] += elapsed
+    
+    def _deduplicate_images(self, messages: List[Dict]):
+        """
+        以感知雜湊移除對話中幾乎相同的截圖（直接修改 messages）
+        
+        - 與之後截圖幾乎相同（雜湊相近，且沒有變動或變動範圍只有游標大小）的較舊截圖改為簡短文字說明，保留最新的一張
+        - 啟用 IMAGE_CROP_CHANGED 時，與前一張相似的截圖只保留有變動的區域
+        """
+        # 少於兩張圖片不可能重複，不必解碼（popup 目前不傳送歷史截圖，多數請求都在這裡返回）
+        image_count = sum(1 for msg in messages if msg.get("images"))
+        self.image_stats['images_received'] += image_count
+        if image_count < 2:
+            return
+        
+        entries = []
+        for msg in messages:
+            if msg.get("images"):
+                try:
+                    img = Image.open(BytesIO(base64.b64decode(msg["images"][0])))
+                    entries.append({'message': msg, 'image': img, 'hash': self._image_hash(msg["images"][0], img)})
+                except Exception as e:
+                    print(f"⚠️  無法計算圖片雜湊: {e}")
+        
+        if len(entries) < 2:
+            return
+        
+        tokens_saved = 0
+        
+        # 由新到舊比對，與較新截圖幾乎相同的舊截圖以文字取代
+        kept = []
+        for entry in reversed(entries):
+            if any(self._is_duplicate_image(entry, k) for k in kept):
+                msg = entry['message']
+                msg["images"] = None
+                msg["content"] = f"{msg['content']}\n（此處原附截圖與之後的截圖幾乎相同，已省略）"
+                tokens_saved += estimate_image_tokens(*entry['image'].size)
+                self.image_stats['duplicates_dropped'] += 1
+            else:
+                kept.append(entry)
+        kept.reverse()
+        
+        # 與前一張相似的截圖只保留變動區域
+        if self.image_crop_enabled:
+            for previous, entry in zip(kept, kept[1:]):
+                if hamming_distance(previous['hash'], entry['hash']) > self.image_crop_threshold:
+                    continue
+                region = changed_region(previous['image'], entry['image'])
+                if region is None:
+                    continue
+                
+                width, height = entry['image'].size
+                crop_width, crop_height = region[2] - region[0], region[3] - region[1]
+                if crop_width * crop_height > width * height * self.image_crop_max_area:
+                    continue
+                
+                buffer = BytesIO()
+                entry['image'].crop(region).convert('RGB').save(buffer, format='JPEG', quality=85)
+                msg = entry['message']
+                msg["images"] = [base64.b64encode(buffer.getvalue()).decode('utf-8')]
+                msg["content"] = f"{msg['content']}\n（截圖只保留與前一張截圖相比有變動的區域）"
+                tokens_saved += estimate_image_tokens(width, height) - estimate_image_tokens(crop_width, crop_height)
+                self.image_stats['regions_cropped'] += 1
+        
+        if tokens_saved:
+            self.image_stats['estimated_tokens_saved'] += tokens_saved
+            print(f"🖼️  截圖去重：節省約 {tokens_saved} 個圖片 token")
+    
+    def _is_duplicate_image(self, entry: Dict, other: Dict) -> bool:
+        """
+        判斷兩張截圖是否幾乎相同：感知雜湊相近，且沒有超過雜訊的變動，或變動外框只有游標大小
+        （不超過 IMAGE_DEDUP_MAX_CHANGED_WIDTH x IMAGE_DEDUP_MAX_CHANGED_HEIGHT 像素；尺寸不同時縮放後比較）
+        
+        不以整張畫面的變動比例判斷：一行錯誤訊息只佔極少像素，卻正是用戶要問的內容
+        """
+        if hamming_distance(entry['hash'], other['hash']) > self.image_dedup_threshold:
+            return False
+        bbox = changed_bbox(entry['image'], other['image'])
+        if bbox is None:
+            return True
+        left, upper, right, lower = bbox
+        return (right - left <= self.image_dedup_max_changed_width
+                and lower - upper <= self.image_dedup_max_changed_height)
+    
+    def _image_hash(self, image_base64: str, img: Image.Image) -> int:
+        """取得圖片的感知雜湊（以 base64 內容快取，最多保留 256 筆）"""
+        key = hashlib.sha1(image_base64.encode('utf-8')).hexdigest()
+        if key in self.image_hash_cache:
+            self.image_hash_cache.move_to_end(key)
+            return self.image_hash_cache[key]
+        
+        value = dhash(img)
+        self.image_hash_cache[key] = value
+        if len(self.image_hash_cache) > 256:
+            self.image_hash_cache.popitem(last=False)
+        return value
     
     def _clean_base64(self, image: str) -> str:
         """清理並壓縮 base64 圖片"""
@@ -246,3 +803,25 @@ class LLMHandler:
     def get_memory_variables(self):
         """獲取記憶中的變數（保留方法以保持 API 兼容性）"""
         return {}
+    
+    def get_stats(self) -> Dict:
+        """取得服務統計資訊（知識庫與檢索）"""
+        stats = self.response_stats
+        total_answers = stats['direct_answers'] + stats['llm_answers']
+        return {
+            'model': self.model_name,
+            'knowledge_base': self.knowledge_base.get_stats() if self.knowledge_base else None,
+            'responses': {
+                'direct_answer_enabled': self.direct_answer_config['enabled'],
+                'direct_answers': stats['direct_answers'],
+                'llm_answers': stats['llm_answers'],
+                'direct_answer_share': stats['direct_answers'] / total_answers if total_answers else 0.0,
+                'avg_direct_seconds': (
+                    stats['direct_seconds'] / stats['direct_answers'] if stats['direct_answers'] else 0.0
+                ),
+                'avg_llm_seconds': stats['llm_seconds'] / stats['llm_answers'] if stats['llm_answers'] else 0.0
+            },
+            'prefetch': self._prefetch_stats_snapshot(),
+            'knowledge_version': self.get_reload_status(),
+            'images': dict(self.image_stats)
+        }
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
@@ -25,6 +25,9 @@ app.add_middleware(
 # 初始化 LLM Handler
 llm_handler = LLMHandler()
 
+# 管理端點的存取權杖（未設定時不檢查）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 
 # 請求模型
 class Message(BaseModel):
@@ -37,6 +40,13 @@ class ChatRequest(BaseModel):
     message: str
     image: Optional[str] = None
     history: Optional[List[Message]] = []
+    force_llm: bool = False  # 強制使用 LLM，不走直接回答模式
+    session_id: Optional[str] = None  # 用來取用預取的檢索結果
+
+
+class PrefetchRequest(BaseModel):
+    session_id: str
+    message: str
 
 
 class ChatResponse(BaseModel):
@@ -86,7 +96,9 @@ async def chat(request: ChatRequest):
         response = await llm_handler.generate_response(
             message=request.message,
             image=request.image,
-            history=history
+            history=history,
+            force_llm=request.force_llm,
+            session_id=request.session_id
         )
         llm_time = time.time() - llm_start
         total_time = time.time() - start_time
@@ -100,6 +112,46 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"處理請求時發生錯誤: {str(e)}")
 
 
+@app.post("/api/prefetch")
+async def prefetch(request: PrefetchRequest):
+    """
+    用戶輸入中預先檢索（低優先，聊天請求進行中時會略過）
+    結果暫存在該 session，送出的訊息相同或幾乎相同時 /api/chat 會直接使用
+    """
+    status = llm_handler.prefetch(request.session_id, request.message)
+    return {"status": status}
+
+
+@app.get("/api/stats")
+async def stats():
+    """取得檢索與回應統計（快速路徑命中率、直接回答比例與延遲等）"""
+    return llm_handler.get_stats()
+
+
+def verify_admin_token(token: Optional[str]):
+    """檢查管理端點的存取權杖"""
+    if ADMIN_TOKEN and token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理權杖錯誤")
+
+
+@app.post("/api/admin/reload")
+async def reload_knowledge(x_admin_token: Optional[str] = Header(None)):
+    """
+    在背景重新載入知識文檔與系統規則，建好後原子性替換
+    進行中的請求會繼續使用舊版本直到完成
+    """
+    verify_admin_token(x_admin_token)
+    status = llm_handler.request_reload()
+    return {"status": status, **llm_handler.get_reload_status()}
+
+
+@app.get("/api/admin/reload")
+async def reload_status(x_admin_token: Optional[str] = Header(None)):
+    """取得熱更新狀態（目前版本雜湊、上次重載耗時與替換時間）"""
+    verify_admin_token(x_admin_token)
+    return llm_handler.get_reload_status()
+
+
 @app.post("/api/clear_history")
 async def clear_history():
     """清除對話歷史"""
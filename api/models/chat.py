@@ -14,6 +14,14 @@ class ChatRequest(BaseModel):
     message: str
     image: Optional[str] = None
     history: Optional[List[Message]] = []
+    force_llm: bool = False  # 強制使用 LLM，不走直接回答模式
+    session_id: Optional[str] = None  # 用來取用預取的檢索結果
+
+
+class PrefetchRequest(BaseModel):
+    """預取檢索請求模型"""
+    session_id: str
+    message: str  # 輸入框中的部分文字
 
 
 class ChatResponse(BaseModel):
@@ -72,7 +72,7 @@ chrome.tabs.onUpdated.addListener((tabId, changeInfo, tab) => {
 
 // 處理聊天請求
 async function handleChatRequest(data) {
-  const { tabId, message, image, history } = data;
+  const { tabId, sessionId, message, image, history } = data;
   
   // 如果有進行中的請求，取消它
   if (currentController) {
@@ -99,7 +99,7 @@ async function handleChatRequest(data) {
     const response = await fetch('http://localhost:8000/api/chat', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ message, image, history }),
+      body: JSON.stringify({ message, image, history, session_id: sessionId }),
       signal: currentController.signal
     });
     
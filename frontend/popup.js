@@ -18,6 +18,14 @@ let conversationHistory = [];
 let currentTabId = null;
 let pollingInterval = null;
 let isWaitingForResponse = false; // 追蹤是否正在等待回應
+let prefetchTimer = null; // 預取檢索的 debounce 計時器
+let lastPrefetchMessage = '';
+// 每次開啟 popup 產生隨機 session ID，避免不同瀏覽器或用戶的 tab ID 相同而互用預取結果
+const sessionId = crypto.randomUUID();
+
+// 預取設定
+const PREFETCH_DEBOUNCE_MS = 400;
+const PREFETCH_MIN_LENGTH = 2;
 
 // 簡單的 Markdown 解析器
 function parseMarkdown(text) {
@@ -250,8 +258,36 @@ userInput.addEventListener('keydown', (e) => {
 userInput.addEventListener('input', () => {
   userInput.style.height = 'auto';
   userInput.style.height = userInput.scrollHeight + 'px';
+  schedulePrefetch();
 });
 
+// 輸入停頓後預先檢索，送出時後端可直接使用結果
+function schedulePrefetch() {
+  if (prefetchTimer) {
+    clearTimeout(prefetchTimer);
+  }
+  
+  prefetchTimer = setTimeout(() => {
+    prefetchTimer = null;
+    const partial = userInput.value.trim();
+    
+    // 正在等待回應時不預取，避免和聊天請求搶資源
+    if (isWaitingForResponse || partial.length < PREFETCH_MIN_LENGTH || partial === lastPrefetchMessage) {
+      return;
+    }
+    lastPrefetchMessage = partial;
+    
+    fetch(`${API_BASE_URL}/api/prefetch`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ session_id: sessionId, message: partial })
+    }).catch(error => {
+      // 預取失敗不影響正常對話
+      console.log('預取失敗:', error.message);
+    });
+  }, PREFETCH_DEBOUNCE_MS);
+}
+
 // 發送訊息
 async function sendMessage() {
   const message = userInput.value.trim();
@@ -271,6 +307,13 @@ async function sendMessage() {
     }
   }
   
+  // 送出後不再需要預取
+  if (prefetchTimer) {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = null;
+  }
+  lastPrefetchMessage = '';
+  
   // 保存當前的訊息和截圖
   const messageToSend = message || '(附上截圖)';
   const screenshotToSend = currentScreenshot;
@@ -312,6 +355,7 @@ async function sendMessage() {
   // 準備發送的數據
   const requestData = {
     tabId: currentTabId,
+    sessionId: sessionId,
     message: messageToSend,
     image: screenshotToSend,
     history: conversationHistory.slice(-20).map(msg => ({